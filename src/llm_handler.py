@@ -1,139 +1,342 @@
 import os
 import hashlib
+import json
+import re
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from anthropic import Anthropic
 from pathlib import Path
 import sqlite3
 import sqlite_vec
 import sqlite_lembed
 
+SCHEMA_VERSION = 8
+CACHE_DIR = Path.home() / ".cache" / "gitlab-auto-pr"
+EMBEDDING_MODEL = "jinav2"
+MODEL_PATH = Path("models/jina-embeddings-v2-small-en-q5_k_m.gguf")
+
+# Files are embedded in overlapping chunks of roughly 500 tokens
+CHUNK_SIZE = 2000
+CHUNK_OVERLAP = 200
+
 
 class CodebaseLLM:
-    def __init__(self, db_path="embeddings.db"):
+    def __init__(self, db_path=CACHE_DIR / "embeddings.db"):
         self.anthropic_client = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-        self.db_path = db_path
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self.db = self._setup_db()
+        self._db_lock = threading.Lock()
 
         self.excluded = {".git", "__pycache__", "venv", "node_modules", "build", "dist"}
-        self.code_extensions = {
-            ".py",
-            ".js",
-            ".jsx",
-            ".ts",
-            ".tsx",
-            ".java",
-            ".cpp",
-            ".hpp",
-            ".c",
-            ".h",
-            ".cs",
-            ".go",
-            ".rb",
-            ".php",
-            ".swift",
-            ".kt",
-            ".tf",
-            ".toml",
-        }
+        self.code_extensions = frozenset(
+            {
+                "py",
+                "js",
+                "jsx",
+                "ts",
+                "tsx",
+                "java",
+                "cpp",
+                "hpp",
+                "c",
+                "h",
+                "cs",
+                "go",
+                "rb",
+                "php",
+                "swift",
+                "kt",
+                "tf",
+                "toml",
+            }
+        )
 
     def _setup_db(self):
         """Setup SQLite database with vector extension"""
-        db = sqlite3.connect(self.db_path)
+        db = sqlite3.connect(self.db_path, check_same_thread=False)
         db.enable_load_extension(True)
         sqlite_vec.load(db)
         sqlite_lembed.load(db)
         db.enable_load_extension(False)
 
+        # WAL with synchronous=NORMAL avoids an fsync per commit
         db.executescript(
             """
-                INSERT INTO temp.lembed_models(name, model)
-                select 'jinav2', lembed_model_from_file('models/jina-embeddings-v2-small-en-q5_k_m.gguf');
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA temp_store = MEMORY;
+            PRAGMA mmap_size = 268435456;
+            PRAGMA cache_size = -65536;
+        """
+        )
+
+        db.execute(
             """
+                INSERT OR IGNORE INTO temp.lembed_models(name, model)
+                select ?, lembed_model_from_file(?);
+            """,
+            (EMBEDDING_MODEL, str(MODEL_PATH)),
         )
 
-        # Create tables for file index and file hashes
+        # Drop tables from an older layout; the index and embedding cache
+        # are rebuilt on next run
+        if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            db.executescript(
+                f"""
+                DROP TABLE IF EXISTS file_embeddings;
+                DROP TABLE IF EXISTS file_chunks;
+                DROP TABLE IF EXISTS file_meta;
+                DROP TABLE IF EXISTS embedding_cache;
+                DROP TABLE IF EXISTS prompt_cache;
+                PRAGMA user_version = {SCHEMA_VERSION};
+            """
+            )
+
+        # File contents live in a plain table so the KNN scan over the
+        # vector table only touches the embeddings, one row per chunk.
+        # file_chunks maps each chunk's vec0 rowid back to its file, so
+        # deletes are rowid lookups rather than scans of the vector table.
+        # Embeddings are partitioned by top-level directory so a search
+        # scoped to part of the repo skips the rest.
+        # embedding_cache outlives the index and is keyed on chunk hash,
+        # so unchanged chunks are never embedded twice. It keeps the float
+        # vectors; the index stores them quantized to int8. prompt_cache
+        # holds Anthropic responses keyed on a hash of the request, tagged
+        # with the issue they were generated for so they can be dropped.
         db.executescript(
             """
-            CREATE VIRTUAL TABLE IF NOT EXISTS file_embeddings 
-            USING vec0(
+            CREATE TABLE IF NOT EXISTS file_meta (
                 id INTEGER PRIMARY KEY,
-                embedding float[512],
-                path TEXT NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                top_dir TEXT NOT NULL,
                 hash TEXT NOT NULL,
-                +content TEXT NOT NULL,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS file_meta_path_hash
+                ON file_meta (path, hash, model);
+            CREATE TABLE IF NOT EXISTS file_chunks (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL,
+                chunk_idx INTEGER NOT NULL,
+                hash TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS file_chunks_file_id
+                ON file_chunks (file_id);
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                model TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, hash)
+            );
+            CREATE TABLE IF NOT EXISTS prompt_cache (
+                prompt_hash TEXT PRIMARY KEY,
+                issue_hash TEXT,
+                response TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS prompt_cache_issue_hash
+                ON prompt_cache (issue_hash);
+            CREATE VIRTUAL TABLE IF NOT EXISTS file_embeddings
+            USING vec0(
+                embedding int8[512] distance_metric=cosine,
+                top_dir TEXT partition key
             );
         """
         )
         return db
 
-    def _get_file_hash(self, path, content):
-        """Generate a hash of the file content"""
-        return hashlib.sha256(content.encode()).hexdigest()
-
-    def _needs_update(self, path, content):
+    def _get_top_dir(self, relative_path):
+        """Return the top-level directory of a path, or "." for root files"""
+        top_dir, sep, _ = relative_path.partition(os.sep)
+        return top_dir if sep else "."
+
+    def _iter_code_files(self, directory):
+        """Yield paths of code files, skipping excluded directories entirely"""
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in self.excluded:
+                        yield from self._iter_code_files(entry.path)
+                elif entry.is_file():
+                    _, dot, extension = entry.name.rpartition(".")
+                    if dot and extension in self.code_extensions:
+                        yield entry.path
+
+    def _read_file(self, path):
+        """Read a file and hash its content, or return None if unreadable"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            return data.decode(), hashlib.sha256(data).hexdigest()
+        except (UnicodeDecodeError, OSError):
+            return None
+
+    def _chunk_content(self, content, content_hash):
+        """Split content into overlapping chunks and hash each one"""
+        # A file that fits in one chunk is already hashed
+        if len(content) <= CHUNK_SIZE:
+            return [(content_hash, content)]
+
+        step = CHUNK_SIZE - CHUNK_OVERLAP
+        chunks = [
+            content[start : start + CHUNK_SIZE]
+            for start in range(0, max(len(content) - CHUNK_OVERLAP, 1), step)
+        ]
+        return [
+            (hashlib.sha256(chunk.encode()).hexdigest(), chunk) for chunk in chunks
+        ]
+
+    def _quantize(self, embedding):
+        """Quantize a float32 embedding to int8, scaled by its largest component"""
+        values = array("f", embedding)
+        scale = max(map(abs, values), default=0.0) or 1.0
+        return array("b", (round(v / scale * 127) for v in values)).tobytes()
+
+    def _needs_update(self, path, current_hash):
         """Check if file needs to be reindexed"""
-        current_hash = self._get_file_hash(path, content)
         cursor = self.db.execute(
-            "SELECT hash FROM file_embeddings WHERE path = ?", (path,)
+            "SELECT 1 FROM file_meta WHERE path = ? AND hash = ? AND model = ? LIMIT 1",
+            (path, current_hash, EMBEDDING_MODEL),
         )
-        result = cursor.fetchone()
-        return result is None or result[0] != current_hash
+        return cursor.fetchone() is None
 
     def _index_files(self, repo_path):
         """Index all files in the repository"""
-        updated_files = 0
+        updated_rows = []
+        updated_chunks = []
         processed_paths = set()
 
-        for path in Path(repo_path).rglob("*"):
-            if (
-                path.is_file()
-                and not any(x in path.parts for x in self.excluded)
-                and path.suffix in self.code_extensions
-            ):
-                print("Indexing file:", path)
-                try:
-                    content = path.read_text()
-                    relative_path = str(path.relative_to(repo_path))
-                    processed_paths.add(relative_path)
+        paths = list(self._iter_code_files(repo_path))
 
-                    # Check if file needs updating
-                    if not self._needs_update(relative_path, content):
-                        continue
+        # Read and hash on a thread pool; the connection stays on this thread
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for path, result in zip(paths, executor.map(self._read_file, paths)):
+                if result is None:
+                    continue
 
-                    # Delete old entry if exists
-                    self.db.execute(
-                        "DELETE FROM file_embeddings WHERE path = ?", (relative_path,)
-                    )
+                print("Indexing file:", path)
+                content, hash = result
+                relative_path = os.path.relpath(path, repo_path)
+                processed_paths.add(relative_path)
 
-                    hash = self._get_file_hash(relative_path, content)
+                # Check if file needs updating
+                if not self._needs_update(relative_path, hash):
+                    continue
 
-                    cursor = self.db.execute(
-                        """INSERT INTO file_embeddings (path, content, hash, embedding) 
-                           VALUES (?, ?, ?, lembed('jinav2', ?))""",
-                        (relative_path, content, hash, content[:500]),
+                updated_rows.append(
+                    (
+                        relative_path,
+                        self._get_top_dir(relative_path),
+                        hash,
+                        EMBEDDING_MODEL,
+                        content,
                     )
+                )
+                for chunk_idx, (chunk_hash, chunk) in enumerate(
+                    self._chunk_content(content, hash)
+                ):
+                    updated_chunks.append((relative_path, chunk_idx, chunk_hash, chunk))
+
+        # Apply every change in one transaction
+        with self.db:
+            if updated_rows:
+                updated_paths = json.dumps([row[0] for row in updated_rows])
+                chunks = json.dumps(updated_chunks)
+
+                # vec0 has no upsert, so drop the old embeddings first
+                self._delete_chunks(
+                    self.db.execute(
+                        """SELECT id FROM file_meta
+                           WHERE path IN (SELECT value FROM json_each(?))""",
+                        (updated_paths,),
+                    ).fetchall()
+                )
+                self.db.executemany(
+                    """INSERT INTO file_meta (path, top_dir, hash, model, content)
+                       VALUES (?, ?, ?, ?, ?)
+                       ON CONFLICT(path) DO UPDATE
+                       SET top_dir = excluded.top_dir,
+                           hash = excluded.hash,
+                           model = excluded.model,
+                           content = excluded.content""",
+                    updated_rows,
+                )
+
+                # Embed every changed chunk not already in the cache in a
+                # single statement, then copy the vectors into the index
+                self.db.execute(
+                    """INSERT OR IGNORE INTO embedding_cache (model, hash, embedding)
+                       SELECT :model, c.value ->> 2, lembed(:model, c.value ->> 3)
+                       FROM json_each(:chunks) c
+                       WHERE c.value ->> 2 NOT IN
+                           (SELECT hash FROM embedding_cache WHERE model = :model)
+                       GROUP BY c.value ->> 2""",
+                    {"model": EMBEDDING_MODEL, "chunks": chunks},
+                )
+                self.db.execute(
+                    """INSERT INTO file_chunks (file_id, chunk_idx, hash)
+                       SELECT m.id, c.value ->> 1, c.value ->> 2
+                       FROM json_each(?) c
+                       JOIN file_meta m ON m.path = c.value ->> 0""",
+                    (chunks,),
+                )
+                rows = self.db.execute(
+                    """SELECT fc.id, e.embedding, m.top_dir
+                       FROM file_meta m
+                       JOIN file_chunks fc ON fc.file_id = m.id
+                       JOIN embedding_cache e
+                           ON e.model = m.model AND e.hash = fc.hash
+                       WHERE m.path IN (SELECT value FROM json_each(?))""",
+                    (updated_paths,),
+                ).fetchall()
+                self.db.executemany(
+                    """INSERT INTO file_embeddings (rowid, embedding, top_dir)
+                       VALUES (?, vec_int8(?), ?)""",
+                    [
+                        (chunk_id, self._quantize(embedding), top_dir)
+                        for chunk_id, embedding, top_dir in rows
+                    ],
+                )
+
+            # Remove entries for deleted files
+            deleted_files = self.db.execute(
+                """SELECT id FROM file_meta
+                   WHERE path NOT IN (SELECT value FROM json_each(?))""",
+                (json.dumps(sorted(processed_paths)),),
+            ).fetchall()
+            if deleted_files:
+                self._delete_chunks(deleted_files)
+                self.db.executemany("DELETE FROM file_meta WHERE id = ?", deleted_files)
+
+        return len(updated_rows)
+
+    def _delete_chunks(self, file_ids):
+        """Delete the chunks and embeddings of files, given (id,) rows"""
+        for (file_id,) in file_ids:
+            chunk_ids = self.db.execute(
+                "SELECT id FROM file_chunks WHERE file_id = ?", (file_id,)
+            ).fetchall()
+            self.db.executemany(
+                "DELETE FROM file_embeddings WHERE rowid = ?", chunk_ids
+            )
+            self.db.execute("DELETE FROM file_chunks WHERE file_id = ?", (file_id,))
 
-                    updated_files += 1
-
-                except (UnicodeDecodeError, OSError):
-                    continue
-
-        # Remove entries for deleted files
-        cursor = self.db.execute("SELECT path FROM file_embeddings")
-        existing_paths = {row[0] for row in cursor.fetchall()}
-        deleted_paths = existing_paths - processed_paths
+    def _get_issue_hash(self, issue_description):
+        """Hash an issue description for tagging cached responses"""
+        return hashlib.sha256((issue_description or "").encode()).hexdigest()
 
-        if deleted_paths:
-            placeholders = ",".join("?" * len(deleted_paths))
+    def forget_responses(self, issue_description):
+        """Drop cached responses for an issue so a retry generates afresh"""
+        with self._db_lock, self.db:
             self.db.execute(
-                f"DELETE FROM file_embeddings WHERE path IN ({placeholders})",
-                tuple(deleted_paths),
+                "DELETE FROM prompt_cache WHERE issue_hash = ?",
+                (self._get_issue_hash(issue_description),),
             )
 
-        self.db.commit()
-        return updated_files
-
-    def _call_anthropic(self, messages, system=None):
-        """Make a call to the Anthropic API"""
+    def _call_anthropic(self, messages, system=None, issue_description=None):
+        """Make a call to the Anthropic API, returning the response text"""
         kwargs = {
             "model": "claude-3-5-sonnet-latest",
             "max_tokens": 4096,
@@ -142,67 +345,148 @@ class CodebaseLLM:
         if system:
             kwargs["system"] = system
 
-        return self.anthropic_client.messages.create(**kwargs)
+        # Identical requests reuse the earlier response until it is forgotten
+        prompt_hash = hashlib.sha256(
+            json.dumps(kwargs, sort_keys=True).encode()
+        ).hexdigest()
+        with self._db_lock:
+            cached = self.db.execute(
+                "SELECT response FROM prompt_cache WHERE prompt_hash = ?",
+                (prompt_hash,),
+            ).fetchone()
+        if cached:
+            return cached[0]
+
+        response = self.anthropic_client.messages.create(**kwargs).content[0].text
+
+        with self._db_lock, self.db:
+            self.db.execute(
+                """INSERT OR REPLACE INTO prompt_cache
+                       (prompt_hash, issue_hash, response)
+                   VALUES (?, ?, ?)""",
+                (
+                    prompt_hash,
+                    issue_description and self._get_issue_hash(issue_description),
+                    response,
+                ),
+            )
+        return response
+
+    def _embed(self, text):
+        """Embed text, reusing a cached embedding of identical text"""
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        with self.db:
+            self.db.execute(
+                """INSERT OR IGNORE INTO embedding_cache (model, hash, embedding)
+                   SELECT :model, :hash, lembed(:model, :text)
+                   WHERE NOT EXISTS (
+                       SELECT 1 FROM embedding_cache
+                       WHERE model = :model AND hash = :hash
+                   )""",
+                {"model": EMBEDDING_MODEL, "hash": text_hash, "text": text},
+            )
+        return self.db.execute(
+            "SELECT embedding FROM embedding_cache WHERE model = ? AND hash = ?",
+            (EMBEDDING_MODEL, text_hash),
+        ).fetchone()[0]
+
+    def _get_mentioned_top_dirs(self, issue_description):
+        """Get indexed top-level directories the issue references by path"""
+        # Only count a directory written as the start of a path, e.g.
+        # "docs/index.py", not the ordinary word "docs"
+        path_roots = set(
+            re.findall(r"(?:^|[\s`'\"(])(?:\./)?([\w.-]+)/", issue_description)
+        ) - {".", ".."}
+        cursor = self.db.execute("SELECT DISTINCT top_dir FROM file_meta")
+        return [row[0] for row in cursor.fetchall() if row[0] in path_roots]
 
     def _get_relevant_files(self, repo_path, issue_description, max_files=20):
         """Get relevant files using vector similarity search"""
-        # Update index for any changed files
-        updated_count = self._index_files(repo_path)
-        if updated_count > 0:
-            print(f"Updated embeddings for {updated_count} modified files")
-
-        # Get all file names from the database for context
-        cursor = self.db.execute("SELECT path, content FROM file_embeddings")
-        all_files = {row[0]: row[1] for row in cursor.fetchall()}
-
-        # Find similar files
-        query = """
-            SELECT 
-                f.path,
-                f.content,
-                distance
-            FROM file_embeddings f
-            WHERE f.embedding match lembed('jinav2', ?)
-            AND k = ?
-        """
-
-        results = self.db.execute(query, (issue_description, max_files)).fetchall()
-
-        # Ask LLM to identify most relevant file
-        file_context = "\n".join([f"- {path}" for path, _, _ in results])
-        file_selection_prompt = f"""Given this issue description:
-{issue_description}
-
-And these available files:
-{file_context}
+        # The connection is shared by every issue being processed
+        with self._db_lock:
+            # Update index for any changed files
+            updated_count = self._index_files(repo_path)
+            if updated_count > 0:
+                print(f"Updated embeddings for {updated_count} modified files")
+
+            # Embed the issue once and bind the vector to the KNN query
+            query_embedding = self._quantize(self._embed(issue_description))
+
+            # Only search the top-level directories the issue gives paths in
+            top_dirs = self._get_mentioned_top_dirs(issue_description)
+            partition_filter = "AND top_dir = :top_dir" if top_dirs else ""
+
+            # Find similar chunks, ranking each file by its closest chunk.
+            # Over-fetch since several chunks may belong to the same file.
+            query = f"""
+                SELECT
+                    m.path,
+                    m.content,
+                    MIN(v.distance) AS distance
+                FROM (
+                    SELECT rowid, distance
+                    FROM file_embeddings
+                    WHERE embedding MATCH vec_int8(:embedding)
+                    AND k = :k
+                    {partition_filter}
+                    ORDER BY distance
+                ) v
+                JOIN file_chunks fc ON fc.id = +v.rowid
+                JOIN file_meta m ON m.id = fc.file_id
+                GROUP BY m.id
+                ORDER BY distance
+                LIMIT :max_files
+            """
 
-Which single file is most likely to need changes? Respond with just the file path, nothing else."""
-        response = self._call_anthropic(
-            [
-                {"role": "user", "content": file_selection_prompt},
-            ]
-        )
+            results = []
+            for top_dir in top_dirs or [None]:
+                results += self.db.execute(
+                    query,
+                    {
+                        "embedding": query_embedding,
+                        "k": max_files * 4,
+                        "max_files": max_files,
+                        "top_dir": top_dir,
+                    },
+                ).fetchall()
+            results = sorted(results, key=lambda row: row[2])[:max_files]
 
         # Print relevance scores for debugging
         for path, _, distance in results:
             print(f"File: {path}, Relevance: {distance:.3f}")
 
-        most_relevant = response.content[0].text.strip()
-        print(f"LLM selected {most_relevant} as the most relevant file")
-        return {most_relevant: all_files[most_relevant]}
+        if not results:
+            return {}
+
+        # The nearest neighbour is the file most likely to need changes
+        most_relevant, content, _ = results[0]
+        print(f"Selected {most_relevant} as the most relevant file")
+        return {most_relevant: content}
 
     def _build_prompt(self, context, issue_description):
         """Build prompt for the LLM"""
-        return f"""
+        # The codebase comes first and is marked for prompt caching, so
+        # repeat requests for the same files only pay for the issue text
+        return [
+            {
+                "type": "text",
+                "text": f"""
 Based on the following codebase and issue description, provide the entire file with the changes applied.
 
 {context}
-
+""",
+                "cache_control": {"type": "ephemeral"},
+            },
+            {
+                "type": "text",
+                "text": f"""
 Issue Description:
 {issue_description}
 
 Do not return any other text, only provide the entire file with the changes applied. Do not include code blocks (```) in your response.
-"""
+""",
+            },
+        ]
 
     def process_codebase(self, repo_path, issue_description):
         """Process the codebase and return proposed changes"""
@@ -217,10 +501,11 @@ Do not return any other text, only provide the entire file with the changes appl
         response = self._call_anthropic(
             messages=[{"role": "user", "content": prompt}],
             system="You are a helpful programming assistant. Provide the entire file with the changes applied in response to the issue description.",
+            issue_description=issue_description,
         )
 
         first_key = list(files.keys())[0]
-        return {first_key: response.content[0].text}
+        return {first_key: response}
 
     def _build_context(self, files):
         """Build context string from files"""